@@ -5,17 +5,52 @@ https://scrapfly.io/blog/how-to-scrape-instagram/
 To run this scraper set env variable $SCRAPFLY_KEY with your scrapfly API key:
 $ export $SCRAPFLY_KEY="your key from https://scrapfly.io/dashboard"
 """
-import json
+import asyncio
 import os
+import re
 from typing import Dict, Optional
 from urllib.parse import quote
 from datetime import datetime
-import jmespath
 import logging
+import orjson
 from scrapfly import ScrapeConfig, ScrapflyClient
 
 logger = logging.getLogger("data_collector" + "." + __name__)
 
+
+def _get(data, *path):
+    """Follow path through nested dicts, None if any step is missing"""
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def _pluck(items, *path):
+    """Value at path of every item, skipping missing ones (like JMESPath's `items[].path`)"""
+    if not isinstance(items, list):
+        return None
+    values = []
+    for item in items:
+        # `[]` flattens nested lists by one level before projecting
+        for element in item if isinstance(item, list) else (item,):
+            value = _get(element, *path)
+            if value is not None:
+                values.append(value)
+    return values
+
+
+def _nodes(data, *path):
+    """Nodes of the edge list at path"""
+    return _pluck(_get(data, *path, "edges"), "node")
+
+
+def _project(items, parse):
+    """Apply parse to every item, keeping None for a missing list"""
+    return None if items is None else [parse(item) for item in items]
+
+
 class InstagramScraper:
     BASE_CONFIG = {
         # Instagram.com requires Anti Scraping Protection bypass feature.
@@ -25,6 +60,12 @@ class InstagramScraper:
     }
     INSTAGRAM_APP_ID = "936619743392459"  # this is the public app id for instagram.com
     INSTAGRAM_DOCUMENT_ID = "8845758582119845" # constant id for post documents instagram.com
+    # only the shortcode varies between post requests, and valid shortcodes are URL-safe
+    SHORTCODE_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+    POST_BODY_TEMPLATE = "variables=" + quote(
+        '{"shortcode":"__SHORTCODE__","fetch_tagged_user_count":null,"hoisted_comment_id":null,"hoisted_reply_id":null}'
+    ) + f"&doc_id={INSTAGRAM_DOCUMENT_ID}"
+    USER_POSTS_URL = "https://www.instagram.com/graphql/query/?query_hash=e769aa130647d2354c40ea6a439bfc08&variables="
 
     def __init__(self):
         self.scrapfly = ScrapflyClient(key=os.environ["SCRAPFLY_KEY"])
@@ -34,68 +75,66 @@ class InstagramScraper:
     def parse_user(data: Dict) -> Dict:
         """Reduce the user data to the relevant fields"""
         logger.debug("parsing user data {}", data["username"])
-        result = jmespath.search(
-            """{
-            id: id,
-            username: username,
-            name: full_name,
-            profile_picture_url: profile_pic_url_hd,
-            biography: biography,
-            category: category_name,
-            n_followers: edge_followed_by.count,
-            n_follows: edge_follow.count,
-            n_posts: edge_owner_to_timeline_media.count,
-            is_business_account: is_business_account,
-            business_category: business_category_name,
-            is_professional_account: is_professional_account,
-            is_joined_recently: is_joined_recently,
-            is_verified: is_verified,
-            is_private: is_private,
-            is_regulated_c18: is_regulated_c18,
-            
-            external_url: external_url,
-            related_accounts: edge_related_profiles.edges[].node.username,
-            
-            bio_links: bio_links[].url,
-
-            video_count: edge_felix_video_timeline.count,
-            videos: edge_felix_video_timeline.edges[].node.{
-                id: id, 
-                title: title,
-                shortcode: shortcode,
-                thumb: display_url,
-                url: video_url,
-                views: video_view_count,
-                tagged: edge_media_to_tagged_user.edges[].node.user.username,
-                captions: edge_media_to_caption.edges[].node.text,
-                comments_count: edge_media_to_comment.count,
-                comments_disabled: comments_disabled,
-                taken_at: taken_at_timestamp,
-                likes: edge_liked_by.count,
-                location: location.name,
-                duration: video_duration
-            },
-            
-            images: edge_felix_video_timeline.edges[].node.{
-                id: id, 
-                title: title,
-                shortcode: shortcode,
-                src: display_url,
-                url: video_url,
-                views: video_view_count,
-                tagged: edge_media_to_tagged_user.edges[].node.user.username,
-                captions: edge_media_to_caption.edges[].node.text,
-                comments_count: edge_media_to_comment.count,
-                comments_disabled: comments_disabled,
-                taken_at: taken_at_timestamp,
-                likes: edge_liked_by.count,
-                location: location.name,
-                accesibility_caption: accessibility_caption,
-                duration: video_duration
-            }
-        }""",
-            data,
-        )
+        videos = _nodes(data, "edge_felix_video_timeline")
+        result = {
+            "id": data.get("id"),
+            "username": data.get("username"),
+            "name": data.get("full_name"),
+            "profile_picture_url": data.get("profile_pic_url_hd"),
+            "biography": data.get("biography"),
+            "category": data.get("category_name"),
+            "n_followers": _get(data, "edge_followed_by", "count"),
+            "n_follows": _get(data, "edge_follow", "count"),
+            "n_posts": _get(data, "edge_owner_to_timeline_media", "count"),
+            "is_business_account": data.get("is_business_account"),
+            "business_category": data.get("business_category_name"),
+            "is_professional_account": data.get("is_professional_account"),
+            "is_joined_recently": data.get("is_joined_recently"),
+            "is_verified": data.get("is_verified"),
+            "is_private": data.get("is_private"),
+            "is_regulated_c18": data.get("is_regulated_c18"),
+
+            "external_url": data.get("external_url"),
+            "related_accounts": _pluck(_nodes(data, "edge_related_profiles"), "username"),
+
+            "bio_links": _pluck(data.get("bio_links"), "url"),
+
+            "video_count": _get(data, "edge_felix_video_timeline", "count"),
+            "videos": _project(videos, lambda node: {
+                "id": _get(node, "id"),
+                "title": _get(node, "title"),
+                "shortcode": _get(node, "shortcode"),
+                "thumb": _get(node, "display_url"),
+                "url": _get(node, "video_url"),
+                "views": _get(node, "video_view_count"),
+                "tagged": _pluck(_nodes(node, "edge_media_to_tagged_user"), "user", "username"),
+                "captions": _pluck(_nodes(node, "edge_media_to_caption"), "text"),
+                "comments_count": _get(node, "edge_media_to_comment", "count"),
+                "comments_disabled": _get(node, "comments_disabled"),
+                "taken_at": _get(node, "taken_at_timestamp"),
+                "likes": _get(node, "edge_liked_by", "count"),
+                "location": _get(node, "location", "name"),
+                "duration": _get(node, "video_duration"),
+            }),
+
+            "images": _project(videos, lambda node: {
+                "id": _get(node, "id"),
+                "title": _get(node, "title"),
+                "shortcode": _get(node, "shortcode"),
+                "src": _get(node, "display_url"),
+                "url": _get(node, "video_url"),
+                "views": _get(node, "video_view_count"),
+                "tagged": _pluck(_nodes(node, "edge_media_to_tagged_user"), "user", "username"),
+                "captions": _pluck(_nodes(node, "edge_media_to_caption"), "text"),
+                "comments_count": _get(node, "edge_media_to_comment", "count"),
+                "comments_disabled": _get(node, "comments_disabled"),
+                "taken_at": _get(node, "taken_at_timestamp"),
+                "likes": _get(node, "edge_liked_by", "count"),
+                "location": _get(node, "location", "name"),
+                "accesibility_caption": _get(node, "accessibility_caption"),
+                "duration": _get(node, "video_duration"),
+            }),
+        }
         return result
 
 
@@ -109,76 +148,67 @@ class InstagramScraper:
                 **self.BASE_CONFIG,
             )
         )
-        data = json.loads(result.content)
+        data = orjson.loads(result.content)
         return self.parse_user(data["data"]["user"])
 
     @staticmethod
     def parse_comments(data: Dict) -> Dict:
         """Parse the comments data from the post dataset"""
         if "edge_media_to_comment" in data:
-            return jmespath.search(
-                """{
-                    comments_count: edge_media_to_comment.count,
-                    comments_disabled: comments_disabled,
-                    comments_next_page: edge_media_to_comment.page_info.end_cursor,
-                    comments: edge_media_to_comment.edges[].node.{
-                        id: id,
-                        text: text,
-                        created_at: created_at,
-                        owner_id: owner.id,
-                        owner: owner.username,
-                        owner_verified: owner.is_verified,
-                        viewer_has_liked: viewer_has_liked
-                    }
-                }""",
-                data,
-            )
+            return {
+                "comments_count": _get(data, "edge_media_to_comment", "count"),
+                "comments_disabled": data.get("comments_disabled"),
+                "comments_next_page": _get(data, "edge_media_to_comment", "page_info", "end_cursor"),
+                "comments": _project(_nodes(data, "edge_media_to_comment"), lambda node: {
+                    "id": _get(node, "id"),
+                    "text": _get(node, "text"),
+                    "created_at": _get(node, "created_at"),
+                    "owner_id": _get(node, "owner", "id"),
+                    "owner": _get(node, "owner", "username"),
+                    "owner_verified": _get(node, "owner", "is_verified"),
+                    "viewer_has_liked": _get(node, "viewer_has_liked"),
+                }),
+            }
         else:
-            return jmespath.search(
-                """{
-                    comments_count: edge_media_to_parent_comment.count,
-                    comments_disabled: comments_disabled,
-                    comments_next_page: edge_media_to_parent_comment.page_info.end_cursor,
-                    comments: edge_media_to_parent_comment.edges[].node.{
-                        id: id,
-                        text: text,
-                        created_at: created_at,
-                        owner: owner.username,
-                        owner_verified: owner.is_verified,
-                        viewer_has_liked: viewer_has_liked,
-                        likes: edge_liked_by.count
-                    }
-                }""",
-                data,
-            )
+            return {
+                "comments_count": _get(data, "edge_media_to_parent_comment", "count"),
+                "comments_disabled": data.get("comments_disabled"),
+                "comments_next_page": _get(data, "edge_media_to_parent_comment", "page_info", "end_cursor"),
+                "comments": _project(_nodes(data, "edge_media_to_parent_comment"), lambda node: {
+                    "id": _get(node, "id"),
+                    "text": _get(node, "text"),
+                    "created_at": _get(node, "created_at"),
+                    "owner": _get(node, "owner", "username"),
+                    "owner_verified": _get(node, "owner", "is_verified"),
+                    "viewer_has_liked": _get(node, "viewer_has_liked"),
+                    "likes": _get(node, "edge_liked_by", "count"),
+                }),
+            }
 
     def parse_post(self, data: Dict) -> Dict:
         """Reduce post dataset to the most important fields"""
         logger.debug("parsing post data {}", data["shortcode"])
-        result = jmespath.search(
-            """{
-            id: id,
-            shortcode: shortcode,
-            dimensions: dimensions,
-            src: display_url,
-            thumbnail_src: thumbnail_src,
-            media_preview: media_preview,
-            video_url: video_url,
-            views: video_view_count,
-            likes: edge_media_preview_like.count,
-            location: location.name,
-            taken_at: taken_at_timestamp,
-            related: edge_web_media_to_related_media.edges[].node.shortcode,
-            type: product_type,
-            video_duration: video_duration,
-            music: clips_music_attribution_info,
-            is_video: is_video,
-            tagged_users: edge_media_to_tagged_user.edges[].node.user.username,
-            captions: edge_media_to_caption.edges[].node.text,
-            related_profiles: edge_related_profiles.edges[].node.username
-        }""",
-            data,
-        )
+        result = {
+            "id": data.get("id"),
+            "shortcode": data.get("shortcode"),
+            "dimensions": data.get("dimensions"),
+            "src": data.get("display_url"),
+            "thumbnail_src": data.get("thumbnail_src"),
+            "media_preview": data.get("media_preview"),
+            "video_url": data.get("video_url"),
+            "views": data.get("video_view_count"),
+            "likes": _get(data, "edge_media_preview_like", "count"),
+            "location": _get(data, "location", "name"),
+            "taken_at": data.get("taken_at_timestamp"),
+            "related": _pluck(_nodes(data, "edge_web_media_to_related_media"), "shortcode"),
+            "type": data.get("product_type"),
+            "video_duration": data.get("video_duration"),
+            "music": data.get("clips_music_attribution_info"),
+            "is_video": data.get("is_video"),
+            "tagged_users": _pluck(_nodes(data, "edge_media_to_tagged_user"), "user", "username"),
+            "captions": _pluck(_nodes(data, "edge_media_to_caption"), "text"),
+            "related_profiles": _pluck(_nodes(data, "edge_related_profiles"), "username"),
+        }
         comments_data = self.parse_comments(data)
         result.update(comments_data)
 
@@ -191,12 +221,10 @@ class InstagramScraper:
             shortcode = url_or_shortcode.split("/p/")[-1].split("/")[0]
         else:
             shortcode = url_or_shortcode
+        if not self.SHORTCODE_PATTERN.fullmatch(shortcode):
+            raise ValueError(f"invalid instagram post shortcode: {shortcode!r}")
         logger.info("scraping instagram post: {}", shortcode)
-        variables = quote(json.dumps({
-            'shortcode':shortcode,'fetch_tagged_user_count':None,
-            'hoisted_comment_id':None,'hoisted_reply_id':None
-        }, separators=(',', ':')))
-        body = f"variables={variables}&doc_id={self.INSTAGRAM_DOCUMENT_ID}"
+        body = self.POST_BODY_TEMPLATE.replace("__SHORTCODE__", shortcode)
         url = "https://www.instagram.com/graphql/query"
         result = await self.scrapfly.async_scrape(
             ScrapeConfig(
@@ -208,36 +236,53 @@ class InstagramScraper:
             )
         )
         
-        data = json.loads(result.content)
+        data = orjson.loads(result.content)
         return self.parse_post(data["data"]["xdt_shortcode_media"])
 
 
-    async def scrape_user_posts(self, user_id: str, page_size=24, max_pages: Optional[int] = None, date_from: Optional[datetime] = None):
-        """Scrape all posts of an instagram user of given numeric user id"""
-        base_url = "https://www.instagram.com/graphql/query/?query_hash=e769aa130647d2354c40ea6a439bfc08&variables="
+    async def _fetch_user_posts_page(self, user_id: str, page_size: int, after: Optional[str]) -> Dict:
+        """Fetch a single page of a user's timeline media"""
         variables = {
             "id": user_id,
             "first": page_size,
-            "after": None,
+            "after": after,
         }
+        url = self.USER_POSTS_URL + quote(orjson.dumps(variables), safe="")
+        result = await self.scrapfly.async_scrape(ScrapeConfig(url, **self.BASE_CONFIG))
+        data = orjson.loads(result.content)
+        return data["data"]["user"]["edge_owner_to_timeline_media"]
+
+    async def scrape_user_posts(self, user_id: str, page_size=24, max_pages: Optional[int] = None, date_from: Optional[datetime] = None):
+        """Scrape all posts of an instagram user of given numeric user id
+
+        The next page is requested before the posts of the current page are parsed,
+        so parsing overlaps with the network round trip.
+        """
+        after = None
         _page_number = 1
-        while True:
-            url = base_url + quote(json.dumps(variables))
-            result = await self.scrapfly.async_scrape(ScrapeConfig(url, **self.BASE_CONFIG))
-            data = json.loads(result.content)
-            posts = data["data"]["user"]["edge_owner_to_timeline_media"]
-            for post in posts["edges"]:
-                yield self.parse_post(post["node"])
-            page_info = posts["page_info"]
-            if _page_number == 1:
-                logger.info(f"scraping total {posts['count']} posts of {user_id}")
-            else:
-                logger.info(f"scraping posts page {_page_number}")
-            if not page_info["has_next_page"]:
-                break
-            if variables["after"] == page_info["end_cursor"]:
-                break
-            variables["after"] = page_info["end_cursor"]
-            _page_number += 1
-            if max_pages and _page_number > max_pages:
-                break
\ No newline at end of file
+        next_page = None
+        posts = await self._fetch_user_posts_page(user_id, page_size, after)
+        try:
+            while True:
+                page_info = posts["page_info"]
+                if _page_number == 1:
+                    logger.info(f"scraping total {posts['count']} posts of {user_id}")
+                else:
+                    logger.info(f"scraping posts page {_page_number}")
+
+                next_page = None
+                has_more = page_info["has_next_page"] and page_info["end_cursor"] != after
+                if has_more and not (max_pages and _page_number + 1 > max_pages):
+                    after = page_info["end_cursor"]
+                    next_page = asyncio.create_task(self._fetch_user_posts_page(user_id, page_size, after))
+
+                for post in posts["edges"]:
+                    yield self.parse_post(post["node"])
+
+                if next_page is None:
+                    break
+                posts = await next_page
+                _page_number += 1
+        finally:
+            if next_page is not None and not next_page.done():
+                next_page.cancel()
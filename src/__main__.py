@@ -1,6 +1,7 @@
-import asyncio
+import uvloop
 
 from .main import main
 
-# Execute the Actor entry point.
-asyncio.run(main())
+# Execute the Actor entry point on the libuv-based event loop.
+if __name__ == "__main__":
+    uvloop.run(main())
@@ -1,227 +1,477 @@
-from httpx import AsyncClient, ReadTimeout, ConnectError
+from httpx import AsyncClient, ReadTimeout, TransportError, HTTPStatusError, Limits, Timeout
 from urllib.parse import quote
-import json
+import orjson
 import os
 import asyncio
+import random
+import re
+import secrets
 from apify import Actor, ProxyConfiguration
-from typing import Dict, List
-from retry import retry
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, List
 from datetime import datetime
 from src.parse import parse_post
-import pdb
 
 INSTAGRAM_DOCUMENT_ID = "8845758582119845"
+# Only the shortcode varies between post requests, and valid shortcodes are URL-safe
+SHORTCODE_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+POST_BODY_TEMPLATE = ("variables=" + quote(
+    '{"shortcode":"__SHORTCODE__","fetch_tagged_user_count":null,"hoisted_comment_id":null,"hoisted_reply_id":null}'
+) + f"&doc_id={INSTAGRAM_DOCUMENT_ID}").encode()
+# Each client serves one post worker or one user timeline, so it never has more than one
+# request in flight and a single kept-alive connection is enough
+CLIENT_LIMITS = Limits(max_connections=1, max_keepalive_connections=1)
+CLIENT_TIMEOUT = Timeout(30)
+# Number of records sent to the dataset per push_data call
+PUSH_CHUNK_SIZE = 500
+# Backoff before a failed shortcode is queued again, in seconds
+REQUEUE_BACKOFF_BASE = 0.5
+REQUEUE_BACKOFF_CAP = 30
+
+_clients: Dict[str, AsyncClient] = {}
+
+
+def get_client(proxy_url: str) -> AsyncClient:
+    """
+    Return the long-lived client for a proxy URL, creating it on first use.
+
+    The URL must come from a sticky proxy session. Without a session id, new_url() returns
+    the same URL every time, and all requests would share one client and one exit IP.
+    """
+    client = _clients.get(proxy_url)
+    if client is None:
+        client = AsyncClient(proxy=proxy_url, http2=True, limits=CLIENT_LIMITS, timeout=CLIENT_TIMEOUT)
+        _clients[proxy_url] = client
+    return client
+
+
+async def release_client(proxy_url: str) -> None:
+    """Close and forget the client of a proxy URL that will not be used again."""
+    client = _clients.pop(proxy_url, None)
+    if client is not None:
+        await client.aclose()
+
+
+async def close_clients() -> None:
+    """Close all cached clients and their connection pools."""
+    await asyncio.gather(*(client.aclose() for client in _clients.values()))
+    _clients.clear()
+
+
+class ConcurrencyLimiter:
+    """
+    Limit on concurrent requests that, unlike asyncio.Semaphore, can be resized while in use.
+
+    Lowering the limit lets in-flight requests finish and holds new ones back until fewer
+    than the new limit are active. The limit never grows beyond its initial value.
+    """
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._max_limit = limit
+        self._active = 0
+        self._generation = 0
+        self._successes = 0
+        self._condition = asyncio.Condition()
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def generation(self) -> int:
+        """Number of times the limit has been halved."""
+        return self._generation
+
+    async def halve(self, generation: int) -> bool:
+        """
+        Halve the limit, unless it has been halved since generation was read.
+
+        Requests read the generation before they start, so a burst of failures from requests
+        that were already in flight lowers the limit only once. Returns whether it was lowered.
+        """
+        async with self._condition:
+            if generation != self._generation:
+                return False
+            self._generation += 1
+            self._limit = max(1, self._limit // 2)
+            self._successes = 0
+            self._condition.notify_all()
+            return True
+
+    async def grow(self) -> None:
+        """
+        Count a successful request, and raise the limit by one once a full limit's worth of
+        requests has succeeded since the last change.
+
+        Growing by one per success would double the limit every round trip and undo a halving
+        almost at once.
+        """
+        async with self._condition:
+            self._successes += 1
+            if self._successes >= self._limit and self._limit < self._max_limit:
+                self._successes = 0
+                self._limit += 1
+                self._condition.notify()
+
+    async def __aenter__(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._active < self._limit)
+            self._active += 1
+
+    async def __aexit__(self, *exc_info) -> None:
+        async with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    async def run(self, awaitable: Awaitable[Any]) -> Any:
+        """Await awaitable while holding one of the slots."""
+        async with self:
+            return await awaitable
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Random delay up to an exponentially growing, capped bound, so retries do not arrive in lockstep."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def with_retry(coro_factory: Callable[[], Awaitable[Any]], tries: int = 3, base: float = 2, cap: float = 30) -> Any:
+    """
+    Await the coroutine made by coro_factory, retrying read timeouts with randomized exponential backoff.
+
+    The backoff uses asyncio.sleep, so the other workers keep running while one waits.
+    """
+    for attempt in range(tries):
+        try:
+            return await coro_factory()
+        except ReadTimeout as e:
+            if attempt == tries - 1:
+                raise
+            delay = backoff_delay(attempt, base, cap)
+            Actor.log.warning(f"{e!r}, retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+
 
-@retry(ReadTimeout, tries=3, delay=2, backoff=2, logger=Actor.log)
 async def scrape_post(client: AsyncClient, shortcode: str) -> Dict:
-    """Scrape single Instagram post data."""
-    variables = json.dumps({
-        'shortcode': shortcode, 
-        'fetch_tagged_user_count': None,
-        'hoisted_comment_id': None, 
-        'hoisted_reply_id': None
-    }, separators=(',', ':'))
-
-    body = f"variables={quote(variables)}&doc_id={INSTAGRAM_DOCUMENT_ID}"
+    """Scrape single Instagram post data. The shortcode must match SHORTCODE_PATTERN."""
+    body = POST_BODY_TEMPLATE.replace(b"__SHORTCODE__", shortcode.encode())
     url = "https://www.instagram.com/graphql/query"
-    response = await client.post(
+    # Stream the response so the body is only read for successful requests
+    async with client.stream(
+        "POST",
         url=url,
         headers={"content-type": "application/x-www-form-urlencoded"},
-        data=body
-    )
-
-    if response.status_code != 200:
-        Actor.log.error(f"Failed to fetch {shortcode}. Status code: {response.status_code}")
-        return None
+        content=body
+    ) as response:
+        if response.status_code == 429:
+            response.raise_for_status()  # Let the caller back off
+        if response.status_code != 200:
+            Actor.log.error(f"Failed to fetch {shortcode}. Status code: {response.status_code}")
+            return None
+        raw = await response.aread()
 
     try:
-        data = json.loads(response.content)["data"]["xdt_shortcode_media"]
+        data = orjson.loads(raw)["data"]["xdt_shortcode_media"]
         return data
     except KeyError:
         Actor.log.error(f"Invalid response format for shortcode {shortcode}.")
         return None
 
 
-async def fetch_post_batch_with_proxy(batch: List[str], proxy_configuration: ProxyConfiguration) -> tuple[list[dict], list[str]]:
-    """Fetch a batch of shortcodes using a new proxy for each batch."""
-    proxy_url = await proxy_configuration.new_url()
-    proxies = {'http://': proxy_url, 'https://': proxy_url}
-    Actor.log.debug(f"Using proxy: {proxy_url}")
-
-    results = []
-    failed = []
-
-    # Async HTTP client with the current proxy
-    try:
-        async with AsyncClient(proxies=proxies) as client:
-            tasks = [scrape_post(client, shortcode) for shortcode in batch]
-            responses = await asyncio.gather(*tasks, return_exceptions=True)
-
-            for shortcode, response in zip(batch, responses):
-                if isinstance(response, Exception) or not response:
-                    Actor.log.debug(f"Failed to fetch shortcode {shortcode}. Re-adding to retry.")
-                    failed.append(shortcode)
-                else:
-                    results.append(parse_post(response))
-
-    except Exception as e:
-        Actor.log.error(f"Error with proxy {proxy_url}: {e}")
-        failed.extend(batch)  # Re-add the entire batch if proxy fails
-
-    return results, failed
-
-async def fetch_user_with_proxy(user_id: str, from_date: datetime, proxy_configuration: ProxyConfiguration, page_size: int, max_pages: int, max_retries: int) -> list:
+async def fetch_user_with_proxy(user_id: str, from_date: datetime, proxy_configuration: ProxyConfiguration, session_prefix: str, page_size: int, max_pages: int, max_retries: int) -> AsyncIterator[dict]:
     """
     Fetch posts of a user using Instagram's GraphQL API.
 
+    Pages are fetched through one sticky proxy session. The session is dropped for a fresh
+    one as soon as it fails at the transport level (connection, proxy or timeout errors) or
+    is rate limited or answered with a server error, so a dead or blocked exit node is never
+    retried. These failures count towards max_retries.
+
     Args:
         user_id (str): Instagram user ID.
         from_date (datetime): Fetch posts only after this date.
         proxy_configuration (ProxyConfiguration): Proxy configuration object.
+        session_prefix (str): Prefix of the proxy session ids, unique to this user and run.
         page_size (int): Number of posts to fetch per page.
         max_pages (int): Maximum number of pages to fetch.
         max_retries (int): Maximum number of retries for failed requests per call.
 
-    Returns:
-        list: List of parsed posts.
+    Yields:
+        dict: Parsed post, as soon as its page has been fetched.
     """
-    posts = []
+    n_posts = 0
     page_number = 1
-    variables = {"id": user_id, "first": page_size, "after": None}
     base_url = "https://www.instagram.com/graphql/query/?query_hash=e769aa130647d2354c40ea6a439bfc08&variables="
-
+    # Only the cursor changes between pages, so the rest of the variables is encoded once
+    url_prefix = base_url + quote('{"id":' + orjson.dumps(user_id).decode() + f',"first":{page_size},"after":', safe="")
+    after = None
+    # Compare raw unix timestamps instead of building a datetime for every post
+    from_ts = from_date.timestamp() if from_date else None
+
+    proxy_url = None
+    n_sessions = 0
     try:
         n_subsequent_errors = 0
         while True:
-            proxy_url = await proxy_configuration.new_url()
-            proxies = {'http://': proxy_url, 'https://': proxy_url}
-            Actor.log.info(f"Using proxy: {proxy_url}")
+            if proxy_url is None:
+                n_sessions += 1
+                proxy_url = await proxy_configuration.new_url(session_id=f"{session_prefix}_{n_sessions}")
+                Actor.log.info(f"Using proxy: {proxy_url}")
             try:
-                async with AsyncClient(proxies=proxies) as client:
-                    response = await client.get(base_url + quote(json.dumps(variables)))
-
+                client = get_client(proxy_url)
+                url = url_prefix + quote(orjson.dumps(after) + b"}", safe="")
+                async with client.stream("GET", url) as response:
+                    if response.status_code == 429 or response.status_code >= 500:
+                        response.raise_for_status()  # Rotate the session below
                     if response.status_code != 200:
                         Actor.log.error(f"Failed to fetch user {user_id}. Status code: {response.status_code}")
                         n_subsequent_errors += 1
                         break
                     else:
                         n_subsequent_errors = 0
-                    
-                    data = response.json()
-                    timeline_media = data["data"]["user"]["edge_owner_to_timeline_media"]
-                    
-                    for edge in timeline_media["edges"]:
-                        post = parse_post(edge["node"])
-
-                        # Check date condition
-                        if from_date:
-                            created_at = datetime.fromtimestamp(post.get("created_at"))
-                            if created_at < from_date:
-                                Actor.log.info(f"Post date {created_at} older than {from_date}. {len(posts)} shortcodes in queue for user {user_id}. Stopping.")
-                                return posts  # Early exit on date condition
-
-                        posts.append(post)
-
-                    page_info = timeline_media["page_info"]
-                    if page_number == 1:
-                        Actor.log.info(f"Scraping total {timeline_media['count']} posts for user {user_id}")
-                    else:
-                        Actor.log.info(f"Scraping page {page_number}")
+                    raw = await response.aread()
+
+                data = orjson.loads(raw)
+                timeline_media = data["data"]["user"]["edge_owner_to_timeline_media"]
+                
+                for edge in timeline_media["edges"]:
+                    post = parse_post(edge["node"])
+
+                    # Check date condition
+                    if from_ts is not None and (post.get("created_at") or 0) < from_ts:
+                        created_at = datetime.fromtimestamp(post.get("created_at") or 0)
+                        Actor.log.info(f"Post date {created_at} older than {from_date}. {n_posts} shortcodes in queue for user {user_id}. Stopping.")
+                        return  # Early exit on date condition
+
+                    n_posts += 1
+                    yield post
+
+                page_info = timeline_media["page_info"]
+                if page_number == 1:
+                    Actor.log.info(f"Scraping total {timeline_media['count']} posts for user {user_id}")
+                else:
+                    Actor.log.info(f"Scraping page {page_number}")
 
-                    # Check pagination conditions
-                    if not page_info["has_next_page"]:
-                        break
-                    if variables["after"] == page_info["end_cursor"]:
-                        Actor.log.warning(f"Stuck on the same cursor {variables['after']}. Breaking loop.")
-                        break
+                # Check pagination conditions
+                if not page_info["has_next_page"]:
+                    break
+                if after == page_info["end_cursor"]:
+                    Actor.log.warning(f"Stuck on the same cursor {after}. Breaking loop.")
+                    break
 
-                    # Update cursor and increment page number
-                    variables["after"] = page_info["end_cursor"]
-                    page_number += 1
+                # Update cursor and increment page number
+                after = page_info["end_cursor"]
+                page_number += 1
 
-                    if max_pages > 0 and page_number > max_pages:
-                        Actor.log.info(f"Reached max pages limit: {max_pages}. Stopping.")
-                        break
+                if max_pages > 0 and page_number > max_pages:
+                    Actor.log.info(f"Reached max pages limit: {max_pages}. Stopping.")
+                    break
 
-            except ConnectError as e:
+            except (TransportError, HTTPStatusError) as e:
                 Actor.log.error(f"Error with proxy {proxy_url}: {e}")
+                n_subsequent_errors += 1
                 if n_subsequent_errors >= max_retries:
-                    Actor.log.error(f"Failed 3 times in a row. Stopping.")
+                    Actor.log.error(f"Failed {n_subsequent_errors} times in a row. Stopping.")
                     break
-                continue  # Try with a new proxy on failure
+                # Try again with a new proxy session
+                await release_client(proxy_url)
+                proxy_url = None
 
     except Exception as final_error:
         Actor.log.error(f"Unhandled error during user fetch: {final_error}")
+    finally:
+        if proxy_url is not None:
+            await release_client(proxy_url)
 
-    return posts
-
-async def fetch_users_with_proxy(user_ids: List[str], from_date: datetime, proxy_configuration: ProxyConfiguration, page_size: int, max_pages: int, concurrency_limit: int, max_retries: int) -> list:
+async def fetch_users_with_proxy(user_ids: List[str], from_date: datetime, proxy_configuration: ProxyConfiguration, session_prefix: str, page_size: int, max_pages: int, concurrency_limit: int, max_retries: int) -> AsyncIterator[dict]:
     """
     Fetch posts of multiple users using Instagram's GraphQL API.
 
+    Posts are yielded while the timelines are still being paged. The buffer between the
+    user fetches and the consumer is bounded, so only about page_size * concurrency_limit
+    parsed posts are held in memory at a time.
+
     Args:
         user_ids (List[str]): List of Instagram user IDs.
         from_date (datetime): Fetch posts only after this date.
         proxy_configuration (ProxyConfiguration): Proxy configuration object.
+        session_prefix (str): Prefix of the proxy session ids, unique to this run.
         page_size (int): Number of posts to fetch per page.
         max_pages (int, optional): Maximum number of pages to fetch.
+        concurrency_limit (int): Maximum number of users fetched concurrently.
         max_retries (int, optional): Maximum number of retries for failed requests per call.
 
-    Returns:
-        list: List of parsed posts.
+    Yields:
+        dict: Parsed post of any of the users.
     """
     Actor.log.info(f"Processing {len(user_ids)} users (max_pages: {max_pages}; from_date: {from_date}).")
     semaphore = asyncio.Semaphore(concurrency_limit)
-    async with semaphore:
-        tasks = [fetch_user_with_proxy(user_id, from_date, proxy_configuration, page_size, max_pages, max_retries) for user_id in user_ids]
-        results = await asyncio.gather(*tasks)
-    return results
+    posts: asyncio.Queue = asyncio.Queue(maxsize=page_size * concurrency_limit)
+    done = object()
+
+    async def fetch_user(index, user_id):
+        async with semaphore:
+            # Key the sessions on the position, as user ids are unchecked input of any length
+            async for post in fetch_user_with_proxy(user_id, from_date, proxy_configuration, f"{session_prefix}_user{index}", page_size, max_pages, max_retries):
+                await posts.put(post)
+
+    async def fetch_all():
+        try:
+            await asyncio.gather(*(fetch_user(index, user_id) for index, user_id in enumerate(user_ids)))
+        finally:
+            # Wake the consumer even if the fetches failed
+            await posts.put(done)
 
-async def fetch_posts_with_proxy(shortcodes: List[str],
+    producer = asyncio.create_task(fetch_all())
+    try:
+        while (post := await posts.get()) is not done:
+            yield post
+        await producer  # Raise the error that ended the fetches, if any
+    finally:
+        if not producer.done():
+            producer.cancel()
+            # Make room for the sentinel, so the cancelled producer can finish
+            while not posts.empty():
+                posts.get_nowait()
+            await asyncio.gather(producer, return_exceptions=True)
+
+async def fetch_posts_with_proxy(shortcodes: AsyncIterable[str],
                                  proxy_configuration: ProxyConfiguration,
+                                 session_prefix: str,
                                  batchsize: int = 10,
                                  concurrency_limit: int = 10,
-                                 max_retries: int = 3) -> list:
-    Actor.log.info(f"Processing {len(shortcodes)} inputs in batches of size {batchsize}.")
-    batches = [shortcodes[i:i + batchsize] for i in range(0, len(shortcodes), batchsize)]
-    results = []
-    n_failed = len(shortcodes)
-    semaphore = asyncio.Semaphore(concurrency_limit)
+                                 max_retries: int = 3) -> int:
+    """
+    Fetch posts with a pool of workers consuming a shared queue of shortcodes.
 
-    async def process_batch(batch):
-        async with semaphore:
-            batch_results, failed = await fetch_post_batch_with_proxy(batch, proxy_configuration)
-            if batch_results:
-                results.extend(batch_results)
-            return failed
-
-    no_progress = 0
-    while batches:
-        tasks = [process_batch(batch) for batch in batches]
-        failed_batches = await asyncio.gather(*tasks)
-
-        # Flatten the list of failed batches and re-add them
-        failed_shortcodes = []
-        for failed_batch in failed_batches:
-            for shortcode in failed_batch:
-                failed_shortcodes.append(shortcode)
-
-        # Only continue if n_failed is decreasing
-        if len(failed_shortcodes) >= n_failed:
-            no_progress += 1
-            if no_progress == max_retries:
-                Actor.log.error("No progress after {max_retries}. Stopping.")
-                break
-        else:
-            no_progress = 0
-
-        n_failed = len(failed_shortcodes)
-        batches = [failed_shortcodes[i:i + batchsize] for i in range(0, len(failed_shortcodes), batchsize)]
-        Actor.log.info(f"Retrying {len(failed_shortcodes)} failed shortcode(s).")
-
-    for failed_shortcode in failed_shortcodes:
-        results.append({"shortcode": failed_shortcode, "error": "NOT_FETCHED", "message": f"Failed to fetch {shortcode} after retries."})
-    return results
+    Shortcodes are queued as they arrive, so workers can start while the source is still
+    producing them. There are batchsize * concurrency_limit workers, and every worker takes
+    one shortcode at a time, so a slow request only holds up its own worker. Each worker
+    keeps a sticky proxy session for batchsize requests and rotates to a new one afterwards
+    or on failure.
+
+    The number of concurrent requests is halved when Instagram rate limits a request, at
+    most once per round of requests in flight, and grows back by one per limit successes.
+    Failed shortcodes go back onto the queue after a randomized backoff until they have
+    been attempted max_retries times. Results are pushed to the dataset in chunks of
+    PUSH_CHUNK_SIZE as they come in.
+
+    Args:
+        shortcodes (AsyncIterable[str]): Shortcodes of the posts to fetch. Duplicates are
+            skipped and malformed shortcodes are reported as errors without being requested.
+        proxy_configuration (ProxyConfiguration): Proxy configuration object.
+        session_prefix (str): Prefix of the proxy session ids, unique to this run.
+        batchsize (int): Number of requests per proxy session. Multiplied by
+            concurrency_limit, the number of workers.
+        concurrency_limit (int): Multiplied by batchsize, the number of workers.
+        max_retries (int): Maximum number of attempts per shortcode.
+
+    Returns:
+        int: Number of records pushed, counting an error entry for every shortcode that
+            could not be fetched.
+    """
+    n_workers = max(1, batchsize * concurrency_limit)
+    queue: asyncio.Queue = asyncio.Queue()
+    limiter = ConcurrencyLimiter(n_workers)
+    results = []
+    n_pushed = 0
+    push_lock = asyncio.Lock()
+
+    async def push_results(min_size: int = 1) -> None:
+        nonlocal n_pushed
+        async with push_lock:
+            # Another worker may have pushed the results while this one waited for the lock
+            if len(results) < min_size:
+                return
+            chunk = results[:]
+            await Actor.push_data(chunk)
+            # Records are only dropped once they are stored, and others may have been added meanwhile
+            del results[:len(chunk)]
+            n_pushed += len(chunk)
+
+    requeues = set()
+
+    async def requeue_later(shortcode: str, attempt: int) -> None:
+        await asyncio.sleep(backoff_delay(attempt, REQUEUE_BACKOFF_BASE, REQUEUE_BACKOFF_CAP))
+        queue.put_nowait((shortcode, attempt + 1))
+        queue.task_done()
+
+    async def worker(worker_id: int) -> None:
+        proxy_url = None
+        n_sessions = 0
+        uses_left = 0
+        while True:
+            shortcode, attempt = await queue.get()
+            post = None
+            try:
+                if uses_left == 0:
+                    if proxy_url is not None:
+                        await release_client(proxy_url)
+                    n_sessions += 1
+                    proxy_url = await proxy_configuration.new_url(session_id=f"{session_prefix}_posts{worker_id}_{n_sessions}")
+                    uses_left = batchsize
+                    Actor.log.debug(f"Using proxy: {proxy_url}")
+                uses_left -= 1
+                generation = limiter.generation
+                # Take a slot per attempt, so a worker waiting out a backoff does not hold one
+                data = await with_retry(lambda: limiter.run(scrape_post(get_client(proxy_url), shortcode)))
+                if data:
+                    await limiter.grow()
+                if data:
+                    post = parse_post(data)
+            except HTTPStatusError:
+                if await limiter.halve(generation):
+                    Actor.log.warning(f"Rate limited with proxy {proxy_url}. Lowering concurrency to {limiter.limit}.")
+                else:
+                    Actor.log.debug(f"Rate limited with proxy {proxy_url}.")
+            except Exception as e:
+                Actor.log.debug(f"Error with proxy {proxy_url}: {e}")
+
+            if post is not None:
+                results.append(post)
+            else:
+                uses_left = 0  # Rotate to a new proxy session after a failure
+                if attempt < max_retries:
+                    Actor.log.debug(f"Failed to fetch shortcode {shortcode}. Re-adding to retry.")
+                    # The shortcode is only marked done once it is back on the queue
+                    task = asyncio.create_task(requeue_later(shortcode, attempt))
+                    requeues.add(task)
+                    task.add_done_callback(requeues.discard)
+                    continue
+                Actor.log.error(f"Failed to fetch shortcode {shortcode} after {attempt} attempts.")
+                results.append({"shortcode": shortcode, "error": "NOT_FETCHED", "message": f"Failed to fetch {shortcode} after retries."})
+            queue.task_done()
+            if len(results) >= PUSH_CHUNK_SIZE:
+                await push_results(PUSH_CHUNK_SIZE)
+
+    workers = [asyncio.create_task(worker(worker_id)) for worker_id in range(n_workers)]
+    joined = None
+    seen = set()
+    try:
+        async for shortcode in shortcodes:
+            # Check the type first, the input may contain unhashable items
+            if not isinstance(shortcode, str) or not SHORTCODE_PATTERN.fullmatch(shortcode):
+                Actor.log.error(f"Invalid shortcode {shortcode!r}. Skipping.")
+                results.append({"shortcode": shortcode, "error": "INVALID_SHORTCODE", "message": f"{shortcode!r} is not a valid shortcode."})
+                continue
+            if shortcode in seen:
+                continue
+            seen.add(shortcode)
+            queue.put_nowait((shortcode, 1))
+        Actor.log.info(f"Queued {len(seen)} unique shortcodes for {n_workers} workers.")
+        # Workers only stop on an error, such as a failed push, which would leave the queue undrained
+        joined = asyncio.create_task(queue.join())
+        await asyncio.wait([joined, *workers], return_when=asyncio.FIRST_COMPLETED)
+        for task in workers:
+            if task.done():
+                task.result()
+    finally:
+        pending = [task for task in (joined, *workers, *requeues) if task is not None]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    if results:
+        await push_results()
+    return n_pushed
 
 
 async def main() -> None:
@@ -254,14 +504,20 @@ async def main() -> None:
             groups=["RESIDENTIAL"],
             country_code="US",
         )
+        # Proxy sessions are shared by all runs of the account, so keep this run's ids apart
+        session_prefix = secrets.token_hex(4)
+
+        async def iter_shortcodes():
+            for shortcode in shortcodes:
+                yield shortcode
+            if user_ids:
+                async for post in fetch_users_with_proxy(user_ids, from_date, proxy_configuration, session_prefix, concurrency_limit=concurrency_limit, max_retries=max_retries, max_pages=max_pages, page_size=12):
+                    yield post["shortcode"]
+
+        n_results = 0
+        try:
+            n_results = await fetch_posts_with_proxy(iter_shortcodes(), proxy_configuration, session_prefix, batchsize, concurrency_limit, max_retries)
+        finally:
+            await close_clients()
 
-        results = []
-        if user_ids:
-            user_results = await fetch_users_with_proxy(user_ids, from_date, proxy_configuration, concurrency_limit=concurrency_limit, max_retries=max_retries, max_pages=max_pages, page_size=12)
-            for result in user_results:
-                shortcodes.extend([i["shortcode"] for i in result])
-        if shortcodes:
-            results.extend(await fetch_posts_with_proxy(shortcodes, proxy_configuration, batchsize, concurrency_limit, max_retries))
-        
-        await Actor.push_data(results)
-        Actor.log.info(f"Completed processing. Total results: {len(results)}")
+        Actor.log.info(f"Completed processing. Total results: {n_results}")
@@ -1,113 +1,130 @@
-import jmespath
+from typing import Optional
+
+
+def _get(data, *path):
+    """Follow path through nested dicts, None if any step is missing."""
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def _edge_nodes(data: Optional[dict], *path) -> Optional[list]:
+    """
+    Nodes of the GraphQL edge list at path, None if there is no such list.
+
+    Unlike _nodes in instagram.py, nested lists are not flattened the way JMESPath's `[]`
+    does, since post payloads only ever hold edge dicts here.
+    """
+    edges = _get(data, *path, "edges")
+    if not isinstance(edges, list):
+        return None
+    return [edge["node"] for edge in edges if isinstance(edge, dict) and edge.get("node") is not None]
+
+
+def _node_values(nodes: Optional[list], *path) -> Optional[list]:
+    """
+    Value at path of every node from _edge_nodes, skipping missing ones.
+
+    Unlike _pluck in instagram.py, this takes node lists only and does not flatten them.
+    """
+    if nodes is None:
+        return None
+    return [value for value in (_get(node, *path) for node in nodes) if value is not None]
+
 
 def parse_comment(data: dict) -> dict:
-    _stats: dict = jmespath.search(
-        """{
-        n_comments: edge_media_to_parent_comment.count,
-        comments_disabled: comments_disabled,
-        comments_next_page: edge_media_to_parent_comment.page_info.end_cursor,
-        comments_has_next_page: edge_media_to_parent_comment.page_info.has_next_page
-        }""",
-        data
-    )
-
-    _comments = jmespath.search(
-        """{
-            comments: edge_media_to_parent_comment.edges[].node.{
-                id: id,
-                text: text,
-                created_at: created_at,
-                username: owner.username,
-                n_likes: edge_liked_by.count,
-                n_replies: edge_threaded_comments.count,
-                spam: did_report_as_spam
+    # Stats and comment nodes all live under the same edge, so look it up once
+    parent_comments = data.get("edge_media_to_parent_comment")
+    nodes = _edge_nodes(parent_comments)
+    comments = {
+        "n_comments": _get(parent_comments, "count"),
+        "comments_disabled": data.get("comments_disabled"),
+        "comments_next_page": _get(parent_comments, "page_info", "end_cursor"),
+        "comments_has_next_page": _get(parent_comments, "page_info", "has_next_page"),
+        "comments": None if nodes is None else [
+            {
+                "id": _get(node, "id"),
+                "text": _get(node, "text"),
+                "created_at": _get(node, "created_at"),
+                "username": _get(node, "owner", "username"),
+                "n_likes": _get(node, "edge_liked_by", "count"),
+                "n_replies": _get(node, "edge_threaded_comments", "count"),
+                "spam": _get(node, "did_report_as_spam"),
             }
-        }""",
-        data
-    )
-
-    comments = dict(**_stats)
-    comments['comments'] = _comments['comments']
+            for node in nodes
+        ],
+    }
 
     return comments
 
-def parse_sidecar(data: dict) -> dict:
-    
-    sidecar: dict = jmespath.search(
-        """{
-            sidecar: edge_sidecar_to_children.edges[].node
-        }""",
-        data
-    )
-
-    result = [parse_image(image) for image in sidecar['sidecar']]
+def parse_sidecar(data: dict) -> list:
+    result = [parse_image(image) for image in _edge_nodes(data, "edge_sidecar_to_children") or []]
 
     return result
 
 def parse_image(data: dict) -> dict:
-    result: dict = jmespath.search(
-        """{
-            shortcode: shortcode,
-            url: display_url,
-            alt_text: accessibility_caption,
-            factcheck_rating: fact_check_overall_rating,
-            factcheck_information: fact_check_information,
-            sensitivity_information: sensitivity_friction_info
-        }""",
-        data
-    )
+    result = {
+        "shortcode": data.get("shortcode"),
+        "url": data.get("display_url"),
+        "alt_text": data.get("accessibility_caption"),
+        "factcheck_rating": data.get("fact_check_overall_rating"),
+        "factcheck_information": data.get("fact_check_information"),
+        "sensitivity_information": data.get("sensitivity_friction_info"),
+    }
 
     return result
 
 def parse_video(data: dict) -> dict:
-    result: dict = jmespath.search(
-        """{
-            shortcode: shortcode,
-            url: video_url,
-            alt_text: accessibility_caption,
-            factcheck_rating: fact_check_overall_rating,
-            factcheck_information: fact_check_information,
-            sensitivity_information: sensitivity_friction_info,
-            video_views: video_view_count,
-            video_plays: video_play_count
-        }""",
-        data
-    )
+    result = {
+        "shortcode": data.get("shortcode"),
+        "url": data.get("video_url"),
+        "alt_text": data.get("accessibility_caption"),
+        "factcheck_rating": data.get("fact_check_overall_rating"),
+        "factcheck_information": data.get("fact_check_information"),
+        "sensitivity_information": data.get("sensitivity_friction_info"),
+        "video_views": data.get("video_view_count"),
+        "video_plays": data.get("video_play_count"),
+    }
 
     return result
 
 def parse_post(data: dict) -> dict:
     """Reduce post dataset to the most important fields"""
-    result: dict = jmespath.search(
-        """{
-        id: id,
-        shortcode: shortcode,
-        created_at: taken_at_timestamp,
-        username: owner.username,
-        caption: edge_media_to_caption.edges[].node.text,
-        n_likes: edge_media_preview_like.count,
-        location: location.name,
-        is_video: is_video,
-        is_paid_partnership: is_paid_partnership,
-        tagged_users: edge_media_to_tagged_user.edges[].node.user.username
-    }""",
-        data,
-    )
-
-    # Concatenate caption
-    caption = "\n\n".join(result.get("caption", [])).strip()
-    result["caption"] = caption
+    result = {
+        "id": data.get("id"),
+        "shortcode": data.get("shortcode"),
+        "created_at": data.get("taken_at_timestamp"),
+        "username": _get(data, "owner", "username"),
+        "caption": "\n\n".join(
+            text for text in (_get(node, "text") for node in _edge_nodes(data, "edge_media_to_caption") or []) if text
+        ).strip(),
+        "n_likes": _get(data, "edge_media_preview_like", "count"),
+        "location": _get(data, "location", "name"),
+        "is_video": data.get("is_video"),
+        "is_paid_partnership": data.get("is_paid_partnership"),
+        "tagged_users": _node_values(_edge_nodes(data, "edge_media_to_tagged_user"), "user", "username"),
+    }
 
     # Comments
     result.update(parse_comment(data))
 
     # Media
-    _type = data.get("__typename")
-    if _type == "XDTGraphImage" or _type == "GraphImage":
-        result.update({"images": [parse_image(data)]})
-    elif _type == "XDTGraphVideo" or _type == "GraphVideo":
-        result.update({"videos": [parse_video(data)]})
-    elif _type == "XDTGraphSidecar" or _type == "GraphSidecar":
-        result.update({"images": parse_sidecar(data)})
-
-    return result
\ No newline at end of file
+    media = _MEDIA.get(data.get("__typename"))
+    if media is not None:
+        key, parse_media = media
+        result[key] = parse_media(data)
+
+    return result
+
+
+# Result key and parser for the media of each post type
+_MEDIA = {
+    "XDTGraphImage": ("images", lambda data: [parse_image(data)]),
+    "GraphImage": ("images", lambda data: [parse_image(data)]),
+    "XDTGraphVideo": ("videos", lambda data: [parse_video(data)]),
+    "GraphVideo": ("videos", lambda data: [parse_video(data)]),
+    "XDTGraphSidecar": ("images", parse_sidecar),
+    "GraphSidecar": ("images", parse_sidecar),
+}
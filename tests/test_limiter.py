@@ -0,0 +1,109 @@
+import asyncio
+
+from src.main import ConcurrencyLimiter
+
+
+def test_halve_once_per_generation():
+    async def run():
+        limiter = ConcurrencyLimiter(8)
+        generation = limiter.generation
+        assert await limiter.halve(generation)
+        assert limiter.limit == 4
+        # Requests that started before the first halving must not lower the limit again
+        assert not await limiter.halve(generation)
+        assert limiter.limit == 4
+        assert await limiter.halve(limiter.generation)
+        assert limiter.limit == 2
+
+    asyncio.run(run())
+
+
+def test_halve_keeps_one_slot():
+    async def run():
+        limiter = ConcurrencyLimiter(1)
+        assert await limiter.halve(limiter.generation)
+        assert limiter.limit == 1
+
+    asyncio.run(run())
+
+
+def test_grow_by_one_per_window_of_successes():
+    async def run():
+        limiter = ConcurrencyLimiter(4)
+        await limiter.halve(limiter.generation)
+        assert limiter.limit == 2
+        await limiter.grow()
+        assert limiter.limit == 2
+        await limiter.grow()
+        assert limiter.limit == 3
+        for _ in range(3):
+            await limiter.grow()
+        assert limiter.limit == 4
+        # Never beyond the initial limit
+        for _ in range(10):
+            await limiter.grow()
+        assert limiter.limit == 4
+
+    asyncio.run(run())
+
+
+def test_halve_resets_growth():
+    async def run():
+        limiter = ConcurrencyLimiter(8)
+        await limiter.halve(limiter.generation)
+        for _ in range(3):
+            await limiter.grow()
+        await limiter.halve(limiter.generation)
+        assert limiter.limit == 2
+        await limiter.grow()
+        assert limiter.limit == 2
+
+    asyncio.run(run())
+
+
+def test_blocks_above_limit():
+    async def run():
+        limiter = ConcurrencyLimiter(2)
+        release = asyncio.Event()
+        entered = []
+
+        async def request(i):
+            async with limiter:
+                entered.append(i)
+                await release.wait()
+
+        tasks = [asyncio.create_task(request(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        assert entered == [0, 1]
+        release.set()
+        await asyncio.gather(*tasks)
+        assert entered == [0, 1, 2]
+
+    asyncio.run(run())
+
+
+def test_lowered_limit_holds_back_new_requests_until_in_flight_ones_finish():
+    async def run():
+        limiter = ConcurrencyLimiter(2)
+        releases = [asyncio.Event() for _ in range(3)]
+        entered = []
+
+        async def request(i):
+            async with limiter:
+                entered.append(i)
+                await releases[i].wait()
+
+        tasks = [asyncio.create_task(request(i)) for i in range(2)]
+        await asyncio.sleep(0)
+        await limiter.halve(limiter.generation)
+        tasks.append(asyncio.create_task(request(2)))
+        releases[0].set()
+        await asyncio.sleep(0)
+        # One request is still in flight, which is all the new limit allows
+        assert entered == [0, 1]
+        releases[1].set()
+        releases[2].set()
+        await asyncio.gather(*tasks)
+        assert entered == [0, 1, 2]
+
+    asyncio.run(run())
@@ -0,0 +1,132 @@
+import json
+from pathlib import Path
+
+from src.parse import parse_post
+
+POSTS = json.loads((Path(__file__).parent / "fixtures" / "posts.json").read_text())
+
+
+def test_parse_image_post():
+    assert parse_post(POSTS["image"]) == {
+        "id": "3301234567890123456",
+        "shortcode": "C3abcDEFghi",
+        "created_at": 1707000000,
+        "username": "natgeo",
+        "caption": "Spring melt at Yosemite Falls.\n\nPhoto by @photog",
+        "n_likes": 1520,
+        "location": "Yosemite National Park",
+        "is_video": False,
+        "is_paid_partnership": False,
+        "tagged_users": ["photog"],
+        "n_comments": 2,
+        "comments_disabled": False,
+        "comments_next_page": "QVFCbGlnaHRfY3Vyc29y",
+        "comments_has_next_page": True,
+        "comments": [
+            {
+                "id": "17890000000000001",
+                "text": "Stunning!",
+                "created_at": 1707000500,
+                "username": "hiker",
+                "n_likes": 12,
+                "n_replies": 1,
+                "spam": False,
+            },
+            {
+                "id": "17890000000000002",
+                "text": "Where is this?",
+                "created_at": 1707000900,
+                "username": "traveller",
+                "n_likes": 0,
+                "n_replies": 0,
+                "spam": False,
+            },
+        ],
+        "images": [
+            {
+                "shortcode": "C3abcDEFghi",
+                "url": "https://scontent.cdninstagram.com/v/t51.29350-15/image_1080.jpg",
+                "alt_text": "Photo by National Geographic of a waterfall.",
+                "factcheck_rating": None,
+                "factcheck_information": None,
+                "sensitivity_information": None,
+            }
+        ],
+    }
+
+
+def test_parse_video_post_without_caption_or_comments():
+    assert parse_post(POSTS["video"]) == {
+        "id": "3301234567890123457",
+        "shortcode": "C3abcDEFgho",
+        "created_at": 1707100000,
+        "username": "natgeo",
+        "caption": "",
+        "n_likes": 310,
+        "location": None,
+        "is_video": True,
+        "is_paid_partnership": True,
+        "tagged_users": [],
+        "n_comments": None,
+        "comments_disabled": True,
+        "comments_next_page": None,
+        "comments_has_next_page": None,
+        "comments": None,
+        "videos": [
+            {
+                "shortcode": "C3abcDEFgho",
+                "url": "https://scontent.cdninstagram.com/o1/v/t16/video_720.mp4",
+                "alt_text": None,
+                "factcheck_rating": None,
+                "factcheck_information": None,
+                "sensitivity_information": None,
+                "video_views": 48211,
+                "video_plays": 90210,
+            }
+        ],
+    }
+
+
+def test_parse_sidecar_post_without_caption_edge():
+    assert parse_post(POSTS["sidecar"]) == {
+        "id": "3301234567890123458",
+        "shortcode": "C3abcDEFghu",
+        "created_at": 1707200000,
+        "username": "natgeo",
+        "caption": "",
+        "n_likes": 77,
+        "location": "Paris, France",
+        "is_video": False,
+        "is_paid_partnership": False,
+        "tagged_users": [],
+        "n_comments": 0,
+        "comments_disabled": False,
+        "comments_next_page": None,
+        "comments_has_next_page": False,
+        "comments": [],
+        "images": [
+            {
+                "shortcode": "C3abcDEFgh1",
+                "url": "https://scontent.cdninstagram.com/v/t51.29350-15/slide_1.jpg",
+                "alt_text": "Photo of the Eiffel Tower at dusk.",
+                "factcheck_rating": None,
+                "factcheck_information": None,
+                "sensitivity_information": None,
+            },
+            {
+                "shortcode": "C3abcDEFgh2",
+                "url": "https://scontent.cdninstagram.com/v/t51.29350-15/slide_2.jpg",
+                "alt_text": None,
+                "factcheck_rating": "FALSE",
+                "factcheck_information": {"title": "False information"},
+                "sensitivity_information": None,
+            },
+        ],
+    }
+
+
+def test_parse_post_matches_for_legacy_typenames():
+    for name in ("image", "video", "sidecar"):
+        post = POSTS[name]
+        legacy = dict(post, __typename=post["__typename"].removeprefix("XDT"))
+        assert parse_post(legacy) == parse_post(post)